@@ -3,11 +3,17 @@
 
 import sys
 
+import numpy as np
 import pandas as pd
 
 sys.path.append('../')
 
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
+from numbers import Real
+from itertools import count, repeat, zip_longest
+from operator import itemgetter
 from typing import Optional
 import re
 
@@ -16,9 +22,23 @@ import typer
 from utils.utils import RichConsole
 
 import openpyxl as xl
+import xlsxwriter
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.rich_text import CellRichText
+from openpyxl.worksheet.formula import ArrayFormula
+from pyxlsb import open_workbook as open_xlsb
+from pyxlsb.workbook import Workbook as XlsbWorkbook
 
 app = typer.Typer(rich_markup_mode="rich")
 
+# Number of rows from which the pairing is vectorized with numpy, below the dict based pairing is faster
+VECTORIZE_MIN_ROWS = 10000
+# Number of rows (all sheets) from which the sheets are paired in parallel processes
+PARALLEL_MIN_ROWS = 100000
+
+# Fill of the processed cells that have been paired
+PAIRED_FILL = xl.styles.fills.PatternFill(patternType='solid', fgColor='008000')
+
 
 class RowStopStrategy(str, Enum):
     """
@@ -38,15 +58,337 @@ class ColumnResultStrategy(str, Enum):
     index_column = "index_column"
 
 
-def convert_xlsb_to_xlsx(input_file):
+def _read_header(wb, sheet_name):
+    """
+    Read the header (first row) of a sheet.
+    :param wb: read-only openpyxl workbook or pyxlsb workbook
+    :param sheet_name: sheet name
+    :return: list of the column names
+    """
+    if isinstance(wb, XlsbWorkbook):
+        with wb.get_sheet(sheet_name) as sheet:
+            return [cell.v for cell in next(sheet.rows(), [])]
+    return [cell.value for cell in wb[sheet_name][1]]
+
+
+def _ingest_xlsx(sheet, column_index_process, partition_column_index, row_start_index, max_row):
+    """
+    Stream the processed and partition columns of a read-only openpyxl sheet.
+    :param sheet: read-only worksheet
+    :param column_index_process: column index of the amounts (start from 1)
+    :param partition_column_index: column index of the partition, or None (start from 1)
+    :param row_start_index: first row to read (start from 1)
+    :param max_row: last row to read (included), or None to read until the caller stops
+    :return: generator of (row_index, value, partition), partition is "" without partition column
+    """
+    # both columns are read in the same pass, each iter_rows call parses the whole sheet again in read-only mode
+    # and a random access per row is even slower
+    min_col = max_col = column_index_process
+    if partition_column_index is not None:
+        min_col = min(column_index_process, partition_column_index)
+        max_col = max(column_index_process, partition_column_index)
+    # only the values are read, no Cell object is built, so the row index is tracked here
+    for row_index, row in enumerate(sheet.iter_rows(min_row=row_start_index, max_row=max_row,
+                                                    min_col=min_col, max_col=max_col, values_only=True),
+                                    start=row_start_index):
+        partition_value = row[partition_column_index - min_col] if partition_column_index is not None else ""
+        yield row_index, row[column_index_process - min_col], partition_value
+
+
+def _ingest_dataframe(df, column_index_process, partition_column_index, row_start_index):
+    """
+    Stream the processed and partition columns of a sheet parsed by pandas with header=None.
+    :param df: dataframe of the sheet, the index is the row index - 1
+    :param column_index_process: column index of the amounts (start from 1)
+    :param partition_column_index: column index of the partition, or None (start from 1)
+    :param row_start_index: first row to read (start from 1)
+    :return: generator of (row_index, value, partition), partition is "" without partition column
+    """
+    def column_values(column_index):
+        if column_index > df.shape[1]:
+            return [None] * max(len(df) - row_start_index + 1, 0)
+        # the empty cells are NaN in pandas, None for the other readers
+        column = df.iloc[row_start_index - 1:, column_index - 1]
+        return column.astype(object).where(column.notna(), None).tolist()
+
+    values = column_values(column_index_process)
+    partitions = column_values(partition_column_index) if partition_column_index is not None else repeat("")
+    yield from zip(count(row_start_index), values, partitions)
+
+
+def _ingest_xlsb(wb, sheet_name, column_index_process, partition_column_index, row_start_index):
+    """
+    Stream the processed and partition columns of a xlsb sheet with pyxlsb.
+    :param wb: pyxlsb workbook
+    :param sheet_name: sheet name
+    :param column_index_process: column index of the amounts (start from 1)
+    :param partition_column_index: column index of the partition, or None (start from 1)
+    :param row_start_index: first row to read (start from 1)
+    :return: generator of (row_index, value, partition), partition is "" without partition column
+    """
+    def cell_value(row, column_index):
+        return row[column_index - 1].v if column_index <= len(row) else None
+
+    next_row_index = row_start_index
+    with wb.get_sheet(sheet_name) as sheet:
+        for row in sheet.rows(sparse=True):
+            row_index = row[0].r + 1
+            if row_index < row_start_index:
+                continue
+            # the empty rows are skipped by pyxlsb, yield one to let the caller stop on it
+            if row_index > next_row_index:
+                yield next_row_index, None, ""
+            next_row_index = row_index + 1
+            partition_value = cell_value(row, partition_column_index) if partition_column_index is not None else ""
+            yield row_index, cell_value(row, column_index_process), partition_value
+
+
+def _pair_rows(rows, values, partitions):
+    """
+    Pair the opposite values with the same partition.
+    :param rows: list of row indexes
+    :param values: list of values, parallel to rows
+    :param partitions: list of partitions, parallel to rows
+    :return: list of (row, pair index), the pair index is None if the row has no opposite value
+    """
+    # {(abs_cell_value, partition): (list of positive rows, list of negative rows), ...}
+    hash_map = defaultdict(lambda: ([], []))
+    for row_index, value, partition_value in zip(rows, values, partitions):
+        hash_map[(abs(value), partition_value)][value < 0].append(row_index)
+
+    results = []
+    for idx, cells in enumerate(hash_map.values()):
+        for row_plus, row_minus in zip_longest(cells[0], cells[1]):
+            if row_plus is not None and row_minus is not None:
+                results.append((row_plus, idx))
+                results.append((row_minus, idx))
+
+            elif row_plus is not None:
+                # leave the result cell empty if there is no cell for the minus
+                results.append((row_plus, None))
+
+            else:
+                # leave the result cell empty if there is no cell for the plus
+                results.append((row_minus, None))
+    return results
+
+
+def _pair_sheet(rows, values, partitions):
+    """
+    Pair the opposite values of a sheet, vectorized for the large sheets.
+    :param rows: list of row indexes
+    :param values: list of values, parallel to rows
+    :param partitions: list of partitions, parallel to rows
+    :return: list of (row, pair index), the pair index is None if the row has no opposite value
+    """
+    pair_rows = _pair_rows_vectorized if len(rows) >= VECTORIZE_MIN_ROWS else _pair_rows
+    return pair_rows(rows, values, partitions)
+
+
+def _pair_kernel(keys, negative):
+    """
+    Pair the opposite values with numpy array operations only.
+    The n-th positive value of a key is paired with its n-th negative value.
+    :param keys: int64 array, key id of each row, numbered from 0 by first appearance
+    :param negative: int64 array, 1 if the value of the row is negative, else 0
+    :return: int64 array, the key id of the row if it is paired, else -1
+    """
+    # one group per (key, sign)
+    groups = keys * 2 + negative
+    order = np.argsort(groups, kind="stable")
+    sorted_groups = groups[order]
+    # position of the row among the rows of its group, rows keep their order inside a group
+    group_start = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    group_lengths = np.diff(np.r_[group_start, len(groups)])
+    position = np.empty_like(groups)
+    position[order] = np.arange(len(groups)) - np.repeat(group_start, group_lengths)
+    # number of pairs of each key, the lowest count of the two signs
+    counts = np.bincount(groups, minlength=(keys.max() + 1) * 2).reshape(-1, 2)
+    pair_count = counts.min(axis=1)
+    return np.where(position < pair_count[keys], keys, -1)
+
+
+def _pair_rows_vectorized(rows, values, partitions):
+    """
+    Same as _pair_rows, computed with numpy for the large sheets.
+    :param rows: list of row indexes
+    :param values: list of values, parallel to rows
+    :param partitions: list of partitions, parallel to rows
+    :return: list of (row, pair index), the pair index is None if the row has no opposite value
+    """
+    values = np.asarray(values, dtype=np.float64)
+    # number the (abs value, partition) keys by first appearance, same as the dict insertion order
+    abs_ids, _ = pd.factorize(np.abs(values))
+    partition_ids, partition_uniques = pd.factorize(pd.Series(partitions, dtype=object), use_na_sentinel=False)
+    keys, _ = pd.factorize(abs_ids.astype(np.int64) * len(partition_uniques) + partition_ids)
+    pairs = _pair_kernel(keys.astype(np.int64), (values < 0).astype(np.int64))
+    result = pairs.astype(object)
+    result[pairs < 0] = None
+    return list(zip(rows, result.tolist()))
+
+
+def _result_column_index(column_result_strategy, column_index_process, max_column, column_result_index):
+    """
+    Get the column index of the results.
+    :param column_result_strategy: strategy to store the result
+    :param column_index_process: column index of the amounts (start from 1)
+    :param max_column: number of columns of the sheet
+    :param column_result_index: column index of the results for the index_column strategy (start from 1)
+    :return: column index of the results (start from 1)
+    """
+    if column_result_strategy == ColumnResultStrategy.insert_column_right:
+        return column_index_process + 1
+    elif column_result_strategy == ColumnResultStrategy.add_column_end:
+        return max_column + 1
+    return column_result_index
+
+
+def _write_results(sheet, results, column_index_result, column_index_process):
+    """
+    Write the pairing results in one sequential pass instead of a random access per cell.
+    :param sheet: worksheet to write in
+    :param results: list of (row, pair index or None)
+    :param column_index_result: column index of the results (start from 1)
+    :param column_index_process: column index of the processed amounts, paired cells are filled (start from 1)
     """
-    Convert xlsb to xlsx.
+    if len(results) == 0:
+        return
+    results.sort(key=itemgetter(0))
+    min_row, max_row = results[0][0], results[-1][0]
+    cells_result = sheet.iter_rows(min_row=min_row, max_row=max_row,
+                                   min_col=column_index_result, max_col=column_index_result)
+    cells_process = sheet.iter_rows(min_row=min_row, max_row=max_row,
+                                    min_col=column_index_process, max_col=column_index_process)
+    results = iter(results)
+    row, value = next(results)
+    for row_index, ((cell_result,), (cell_process,)) in enumerate(zip(cells_result, cells_process), start=min_row):
+        # skip the rows without result (gaps)
+        if row_index != row:
+            continue
+        cell_result.value = value
+        if value is not None:
+            cell_process.fill = PAIRED_FILL
+        row, value = next(results, (None, None))
+
+
+def _write_xlsb_result(input_file, output_file, results_by_sheet, column_result_strategy, column_result_index):
+    """
+    Write a xlsx copy of a xlsb file with the results, the rows are streamed in write-only mode.
     :param input_file: xlsb file
-    :return: xlsx file
+    :param output_file: xlsx file
+    :param results_by_sheet: {sheet name: (column_index_process, list of (row, pair index))}
+    :param column_result_strategy: strategy to store the result
+    :param column_result_index: column index of the results for the index_column strategy (start from 1)
+    """
+    out = xl.Workbook(write_only=True)
+    with open_xlsb(input_file) as wb:
+        for sheet_name in wb.sheets:
+            ws = out.create_sheet(sheet_name)
+            with wb.get_sheet(sheet_name) as sheet:
+                if sheet_name not in results_by_sheet:
+                    for row in sheet.rows():
+                        ws.append([cell.v for cell in row])
+                    continue
+
+                column_index_process, results = results_by_sheet[sheet_name]
+                row_to_pair = dict(results)
+                index_column_result = None
+                for row_index, row in enumerate(sheet.rows(), start=1):
+                    values = [cell.v for cell in row]
+                    if index_column_result is None:
+                        index_column_result = _result_column_index(column_result_strategy, column_index_process,
+                                                                   len(values), column_result_index)
+
+                    result = row_to_pair.get(row_index)
+                    if result is not None:
+                        cell = WriteOnlyCell(ws, value=values[column_index_process - 1])
+                        cell.fill = PAIRED_FILL
+                        values[column_index_process - 1] = cell
+                    # the header wins if the first row is processed (--row_start_index 1)
+                    if row_index == 1:
+                        result = "Matching Key"
+
+                    if column_result_strategy != ColumnResultStrategy.index_column:
+                        values.insert(index_column_result - 1, result)
+                    elif row_index == 1 or row_index in row_to_pair:
+                        # override the preexistent data only on the processed rows
+                        values.extend([None] * (index_column_result - len(values)))
+                        values[index_column_result - 1] = result
+                    ws.append(values)
+    out.save(output_file)
+
+
+def _write_fast_result(xls, output_file, sheet_names, dfs, results_by_sheet, column_result_strategy,
+                       column_result_index):
+    """
+    Write every sheet with the results, values only, using pandas and xlsxwriter.
+    :param xls: pandas ExcelFile of the input file
+    :param output_file: xlsx file
+    :param sheet_names: all the sheet names of the input file, in the order of the workbook
+    :param dfs: {sheet name: dataframe parsed with header=None}, for the processed sheets
+    :param results_by_sheet: {sheet name: (column_index_process, list of (row, pair index))}
+    :param column_result_strategy: strategy to store the result
+    :param column_result_index: column index of the results for the index_column strategy (start from 1)
     """
-    # use pandas to convert xlsb to xlsx
-    df = pd.read_excel(input_file, engine='pyxlsb')
-    df.to_excel(input_file.replace('.xlsb', '.xlsx'), index=False)
+    # the text cells that look like URLs are kept as text, not converted to hyperlinks
+    with pd.ExcelWriter(output_file, engine="xlsxwriter",
+                        engine_kwargs={"options": {"strings_to_urls": False}}) as writer:
+        for sheet_name in sheet_names:
+            if sheet_name not in results_by_sheet:
+                # the tabs not processed are copied as is
+                xls.parse(sheet_name, header=None).to_excel(writer, sheet_name=sheet_name, header=False, index=False)
+                continue
+
+            column_index_process, results = results_by_sheet[sheet_name]
+            # the dataframe index is the row index - 1
+            df = dfs[sheet_name]
+            index_column_result = _result_column_index(column_result_strategy, column_index_process,
+                                                       df.shape[1], column_result_index)
+            if column_result_strategy == ColumnResultStrategy.index_column:
+                # override the preexistent data only on the processed rows
+                df = df.reindex(columns=range(max(df.shape[1], index_column_result)))
+                result = df.pop(index_column_result - 1).astype(object)
+            else:
+                result = pd.Series(None, index=df.index, dtype=object)
+            if len(results) > 0:
+                result.loc[[row - 1 for row, _ in results]] = [pair for _, pair in results]
+            # the header wins if the first row is processed (--row_start_index 1)
+            result.loc[0] = "Matching Key"
+            df.insert(index_column_result - 1, "result", result, allow_duplicates=True)
+            df.to_excel(writer, sheet_name=sheet_name, header=False, index=False)
+
+
+def _xlsxwriter_value(value):
+    """
+    Convert an openpyxl cell value that xlsxwriter can't write to its text.
+    :param value: openpyxl cell value
+    :return: value to write with xlsxwriter
+    """
+    if isinstance(value, ArrayFormula):
+        return value.text
+    if isinstance(value, CellRichText):
+        return str(value)
+    return value
+
+
+def _save_values(wb, output_file):
+    """
+    Save the values of every sheet of a workbook with xlsxwriter, the formatting is dropped.
+    Falls back to the openpyxl save if a value can't be written by xlsxwriter (data table formulas).
+    :param wb: openpyxl workbook
+    :param output_file: xlsx file
+    """
+    try:
+        with xlsxwriter.Workbook(output_file, {"constant_memory": True, "default_date_format": "yyyy-mm-dd",
+                                                 "strings_to_urls": False}) as out:
+            for sheet in wb.worksheets:
+                ws = out.add_worksheet(sheet.title)
+                # constant memory mode: the rows must be written in order
+                for row_index, row in enumerate(sheet.iter_rows(min_row=1, min_col=1, values_only=True)):
+                    ws.write_row(row_index, 0, [_xlsxwriter_value(value) for value in row])
+    except TypeError as e:
+        RichConsole.warning(f"Can't save the values only ({e}), the file is saved with its formatting")
+        wb.save(output_file)
 
 
 @app.command()
@@ -92,7 +434,8 @@ def table_import(
         typer.Option(ColumnResultStrategy.insert_column_right,
                      "--column_result_strategy", "--col_result",
                      help="Strategy to store the result.\n"
-                          "'insert_column_right' inserts the result in a new column to the right of the processed column.\n"
+                          "'insert_column_right' inserts the result in a new column to the right of the processed column "
+                          "(columns are only shifted if the processed column is not the last one).\n"
                           "'add_column_end' adds the result in a new column at the end of the sheet.\n"
                           "'index_column' inserts the result in a specific column (will override preexistent data).\n"
                           "Usage: `--col_result insert_column_right`"),
@@ -104,6 +447,17 @@ def table_import(
                                                              help="Column index to partition rows (start from 1). "
                                                                   "If not specified, the whole sheet is processed in on block.\n"
                                                                   "Usage: `--part_col_idx 5`"),
+        fast: bool = typer.Option(False, "--fast",
+                                  help="Read the values with pandas and write the result with xlsxwriter, "
+                                       "much faster on large files. The values of every tab are written "
+                                       "but the formatting is not kept.\n"
+                                       "Usage: `--fast`"),
+        strip_styles: bool = typer.Option(False, "--strip_styles",
+                                          help="Save the values of every tab with xlsxwriter, faster than the "
+                                               "default save on large files but the formatting is dropped "
+                                               "(dates use the yyyy-mm-dd format). No effect with --fast or "
+                                               "a .xlsb input file, which are already saved without formatting.\n"
+                                               "Usage: `--strip_styles`"),
         author: bool = typer.Option(False, "--author", "-a",
                                     help="Print author information and exist.\n"
                                          "Full usage: `python cli.py a -a`"),
@@ -148,161 +502,212 @@ def table_import(
         raise ValueError("--row_start_index must be greater than 0")
     if verbose < 0 or verbose > 2:
         raise ValueError("--verbose must be between 0 and 2")
-
-    # if the file is xlsb, convert it to xlsx
-    if input_file.endswith(".xlsb"):
-        convert_xlsb_to_xlsx(input_file)
-        input_file = input_file.replace(".xlsb", ".xlsx")
-        RichConsole.info(f"Converted {input_file} to {input_file}")
-
-
+    try:
+        column_regex = re.compile(column_pattern)
+    except re.error as e:
+        raise ValueError(f"--column_pattern is not a valid regex: {e}")
 
     # Read the input file
+    # The read-only workbook is only used for the ingestion pass, the editable one is opened later for the write-back.
+    # xlsb files are streamed directly with pyxlsb.
+    is_xlsb = input_file.endswith(".xlsb")
     main_spinner_task = RichConsole.one_shot_task("Opening file")
-    wb = None
+    wb_ro = None
     try:
-        wb = xl.load_workbook(input_file)
+        if is_xlsb:
+            wb_ro = open_xlsb(input_file)
+        else:
+            # cached values only, the external links are not loaded since they are never read here
+            wb_ro = xl.load_workbook(input_file, read_only=True, data_only=True, keep_links=False)
     except Exception as e:
         RichConsole.error(f"Error reading input file {input_file}:\n"
                           f"{e}")
         exit(1)
+    all_sheet_names = wb_ro.sheets if is_xlsb else wb_ro.sheetnames
     main_spinner_task.end()
 
     # Check the input file
     main_spinner_task = RichConsole.one_shot_task("Checking file")
-    if len(wb.sheetnames) == 0:
+    if len(all_sheet_names) == 0:
         RichConsole.error("Input file is empty")
         exit(1)
 
     # Check sheet names
     tab_index = [int(x) for x in tab_index]
     # add the sheet index corresponding name to the list of sheet names
-    tabs.extend([name for idx, name in enumerate(wb.sheetnames) if idx + 1 in tab_index])
+    tabs.extend([name for idx, name in enumerate(all_sheet_names) if idx + 1 in tab_index])
     # remove duplicates
     tabs = set(tabs)
-    sheet_names = set(wb.sheetnames)
+    sheet_names = set(all_sheet_names)
     sheets = []
     for tab in tabs:
         if tab not in sheet_names:
             RichConsole.warning(f"Tab '{tab}' not found in input file")
         else:
-            sheets.append(wb[tab])
+            sheets.append(tab)
     if len(sheets) == 0:
         RichConsole.error("No matching tab found")
         exit(1)
 
     # Check column names for each sheet
+    # {sheet title: column_index_process}
+    sheet_col_idx: dict[str, int] = {}
     for sheet in sheets:
+        # the <dimension> tag of the sheet can be wrong or missing, so the read-only sheet must not trust it
+        if not is_xlsb:
+            wb_ro[sheet].reset_dimensions()
         # Get the column names
-        col_names = [cell.value for cell in sheet[1]]
+        col_names = _read_header(wb_ro, sheet)
         # Check the column names
         if column_index is not None:
             if column_index > len(col_names):
-                RichConsole.error(f"Column index {column_index} not found in sheet '{sheet.title}'")
+                RichConsole.error(f"Column index {column_index} not found in sheet '{sheet}'")
                 exit(1)
             column_name = col_names[column_index - 1]
         else:
-            column_name = next((name for name in col_names if re.match(column_pattern, name)), None)
+            column_name = next((name for name in col_names if column_regex.match(name)), None)
         if column_name is None:
-            RichConsole.error(f"Column name not found in sheet '{sheet.title}'")
+            RichConsole.error(f"Column name not found in sheet '{sheet}'")
             exit(1)
-        RichConsole.debug(f"Found column '{column_name}' in sheet '{sheet.title}'")
+        RichConsole.debug(lambda: f"Found column '{column_name}' in sheet '{sheet}'")
+        sheet_col_idx[sheet] = col_names.index(column_name) + 1
 
     main_spinner_task.end()
 
-    # Process each sheet
-    main_bar_task = RichConsole.progress_bar.add_task("Starting processing", visible=True, total=len(sheets))
+    # Phase 1: ingest each sheet from the read-only workbook
+    # {sheet title: (list of row indexes, list of values, list of partitions)}
+    extracted = {}
+    # with --fast the sheets are read with pandas, {sheet title: dataframe}
+    xls = pd.ExcelFile(input_file, engine="pyxlsb" if is_xlsb else "openpyxl") if fast else None
+    dfs = {}
+    main_bar_task = RichConsole.progress_bar.add_task("Reading sheets", visible=True, total=len(sheets))
     for sheet in sheets:
-        RichConsole.debug(f"Processing sheet '{sheet.title}'")
-        RichConsole.progress_bar.update(main_bar_task, description=f"{sheet.title}")
-
-        # Get the column names
-        col_names = [cell.value for cell in sheet[1]]
-        if column_index is not None:
-            column_name = col_names[column_index - 1]
+        RichConsole.debug(lambda: f"Reading sheet '{sheet}'")
+        RichConsole.progress_bar.update(main_bar_task, description=f"{sheet}")
+
+        column_index_process = sheet_col_idx[sheet]
+        if fast:
+            # the sheet is parsed once, the same dataframe is used to write the result
+            dfs[sheet] = xls.parse(sheet, header=None)
+            rows = _ingest_dataframe(dfs[sheet], column_index_process, partition_column_index, row_start_index)
+        elif is_xlsb:
+            rows = _ingest_xlsb(wb_ro, sheet, column_index_process, partition_column_index, row_start_index)
         else:
-            column_name = next((name for name in col_names if re.match(column_pattern, name)), None)
-        # Get the column index
-        column_index_process = col_names.index(column_name) + 1
-
-        # get the row data and store it in hash map
-        # {abs_cell_value: {"+": list of positive cells, "-": list of negative cells}, ...}
-        hash_map = {}
-        for cell in sheet.iter_rows(min_row=row_start_index, max_row=sheet.max_row, min_col=column_index_process,
-                                    max_col=column_index_process):
-            cell = cell[0]
-            if row_stop_strategy == RowStopStrategy.index_row and cell.row > row_stop_index:
+            # the dimensions have been reset, so without max_row the scan reads until the real end of the data,
+            # on_nan stops earlier with the break below since the rows are read lazily
+            max_row = row_stop_index if row_stop_strategy == RowStopStrategy.index_row else None
+            rows = _ingest_xlsx(wb_ro[sheet], column_index_process, partition_column_index, row_start_index, max_row)
+
+        # get the row data until the stop strategy is reached
+        # stored as parallel lists (row indexes, values, partitions) to keep the memory footprint low
+        rows_index, values, partitions = [], [], []
+        for row_index, value, partition_value in rows:
+            if row_stop_strategy == RowStopStrategy.index_row and row_index > row_stop_index:
                 break
-            if cell.value is None or cell.value == "":
+            # the empty cells stop the process with on_nan, they are ignored by end_of_tab and index_row
+            if value is None or value == "":
                 if row_stop_strategy == RowStopStrategy.on_nan:
                     break
-                elif row_stop_strategy == RowStopStrategy.end_of_tab:
-                    continue
+                continue
+            # checked here so the dict and the vectorized pairing reject the same cells (numeric text included)
+            if not isinstance(value, Real):
+                RichConsole.error(f"Value '{value}' at row {row_index} of sheet '{sheet}' is not a number")
+                exit(1)
+            rows_index.append(row_index)
+            values.append(value)
+            partitions.append(partition_value)
 
-            partition_value = ""
-            if partition_column_index is not None:
-                partition_value = sheet.cell(row=cell.row, column=partition_column_index).value
+        extracted[sheet] = (rows_index, values, partitions)
+        RichConsole.progress_bar.update(main_bar_task, advance=1)
+        RichConsole.refresh()
+    RichConsole.progress_bar.remove_task(main_bar_task)
+    wb_ro.close()
+
+    # Pair the opposite values, the sheets are independent so they are paired in worker processes
+    # when there is enough rows to pay for the processes start and the data transfer
+    # {sheet title: (column_index_process, list of (row, pair index))}
+    main_spinner_task = RichConsole.one_shot_task("Pairing values")
+    ingested = {}
+    if len(sheets) > 1 and sum(len(rows_index) for rows_index, _, _ in extracted.values()) >= PARALLEL_MIN_ROWS:
+        with ProcessPoolExecutor() as executor:
+            futures = {executor.submit(_pair_sheet, *extracted[sheet]): sheet for sheet in sheets}
+            for future in as_completed(futures):
+                sheet = futures[future]
+                ingested[sheet] = (sheet_col_idx[sheet], future.result())
+    else:
+        for sheet in sheets:
+            ingested[sheet] = (sheet_col_idx[sheet], _pair_sheet(*extracted[sheet]))
+    main_spinner_task.end()
 
-            v = str(abs(cell.value)) + partition_value
-            if v not in hash_map:
-                hash_map[v] = {"+": [], "-": []}
-            if cell.value < 0:
-                hash_map[v]["-"].append(cell)
-            else:
-                hash_map[v]["+"].append(cell)
+    if output_file is None:
+        output_file = input_file.replace(".xlsb", ".xlsx") if is_xlsb else input_file
+
+    # Phase 2: write the values only with xlsxwriter
+    if fast:
+        RichConsole.one_shot_task("Processing main job").end()
+        main_spinner_task = RichConsole.one_shot_task("Saving file")
+        _write_fast_result(xls, output_file, all_sheet_names, dfs, ingested, column_result_strategy,
+                           column_result_index)
+        xls.close()
+        main_spinner_task.end()
+        RichConsole.refresh()
+        return
+
+    # Phase 2: the xlsb files can't be written, the results are streamed to a new xlsx file
+    if is_xlsb:
+        RichConsole.one_shot_task("Processing main job").end()
+        main_spinner_task = RichConsole.one_shot_task("Saving file")
+        _write_xlsb_result(input_file, output_file, ingested, column_result_strategy, column_result_index)
+        main_spinner_task.end()
+        RichConsole.refresh()
+        return
+
+    # Phase 2: open the editable workbook, only used to write the results
+    main_spinner_task = RichConsole.one_shot_task("Opening file for writing")
+    wb = None
+    try:
+        wb = xl.load_workbook(input_file)
+    except Exception as e:
+        RichConsole.error(f"Error reading input file {input_file}:\n"
+                          f"{e}")
+        exit(1)
+    main_spinner_task.end()
+
+    # Process each sheet
+    main_bar_task = RichConsole.progress_bar.add_task("Starting processing", visible=True, total=len(sheets))
+    for sheet in [wb[title] for title in sheets]:
+        RichConsole.debug(lambda: f"Processing sheet '{sheet.title}'")
+        RichConsole.progress_bar.update(main_bar_task, description=f"{sheet.title}")
+
+        column_index_process, results = ingested[sheet.title]
 
         # Result column
-        index_column_result = None
-        if column_result_strategy == ColumnResultStrategy.insert_column_right:
-            index_column_result = column_index_process + 1
-            sheet.insert_cols(index_column_result)
-        elif column_result_strategy == ColumnResultStrategy.add_column_end:
-            index_column_result = sheet.max_col + 1
+        index_column_result = _result_column_index(column_result_strategy, column_index_process,
+                                                   sheet.max_column, column_result_index)
+        # insert_cols moves every cell on the right, it is only needed if the result column is not past the last one
+        if column_result_strategy == ColumnResultStrategy.insert_column_right \
+                and index_column_result <= sheet.max_column:
             sheet.insert_cols(index_column_result)
-        elif column_result_strategy == ColumnResultStrategy.index_column:
-            index_column_result = column_result_index
-
-        for idx, hash_map_value in enumerate(hash_map.items()):
-            abs_amount, cells = hash_map_value
-            for index_identical_cell in range(max(len(cells["+"]), len(cells["-"]))):
-                if len(cells["+"]) > index_identical_cell and len(cells["-"]) > index_identical_cell:
-                    cell_plus = cells["+"][index_identical_cell]
-                    cell_minus = cells["-"][index_identical_cell]
-
-                    cell_plus_result = sheet.cell(row=cell_plus.row, column=index_column_result)
-                    cell_minus_result = sheet.cell(row=cell_minus.row, column=index_column_result)
-
-                    cell_plus_result.value = idx
-                    cell_minus_result.value = idx
-                    sheet.cell(cell_minus.row, column_index_process).fill = xl.styles.fills.PatternFill(patternType='solid', fgColor='008000')
-                    sheet.cell(cell_plus.row, column_index_process).fill = xl.styles.fills.PatternFill(patternType='solid', fgColor='008000')
-
-                elif len(cells["+"]) > index_identical_cell:
-                    # leave the result cell empty if there is no cell for the minus
-                    cell_plus = cells["+"][index_identical_cell]
-                    cell_plus_result = sheet.cell(row=cell_plus.row, column=index_column_result)
-                    cell_plus_result.value = None
-
-                elif len(cells["-"]) > index_identical_cell:
-                    # leave the result cell empty if there is no cell for the plus
-                    cell_minus = cells["-"][index_identical_cell]
-                    cell_minus_result = sheet.cell(row=cell_minus.row, column=index_column_result)
-                    cell_minus_result.value = None
+
+        _write_results(sheet, results, index_column_result, column_index_process)
+        # written after the results, the header wins if the first row is processed (--row_start_index 1)
+        sheet.cell(1, index_column_result).value = "Matching Key"
 
         RichConsole.progress_bar.update(main_bar_task, advance=1)
-    sheet.cell(1, column_index_process + 1).value = "Matching Key"
+        RichConsole.refresh()
     RichConsole.progress_bar.remove_task(main_bar_task)
     RichConsole.one_shot_task("Processing main job").end()
 
     main_spinner_task = RichConsole.one_shot_task("Saving file")
 
     # Save the result
-    if output_file is None:
-        output_file = input_file
-    wb.save(output_file)
+    if strip_styles:
+        _save_values(wb, output_file)
+    else:
+        wb.save(output_file)
 
     main_spinner_task.end()
-    RichConsole.live.refresh()
+    RichConsole.refresh()
 
 
 if __name__ == "__main__":
@@ -24,6 +24,7 @@ class OneShotTaskContainer:
         """End the task."""
         if not self.ended:
             self.progress.update(self.task, advance=1)
+            RichConsole.refresh()
         self.ended = True
 
 
@@ -54,12 +55,14 @@ class RichConsole:
                                  f"{'...' if not task.finished else ''}"),
             )
 
+            # no auto refresh, the display is only redrawn at the checkpoints with RichConsole.refresh()
             RichConsole.live = \
                 Live(
                     Group(
                         RichConsole.progress_bar,
                         RichConsole.progress_spinner),
-                    console=Console(color_system="standard"))
+                    console=Console(color_system="standard"),
+                    auto_refresh=False)
             RichConsole.live.start()
 
     @staticmethod
@@ -69,10 +72,16 @@ class RichConsole:
             RichConsole.live = None
 
     @staticmethod
-    def debug(msg: str) -> None:
-        """Print a message if verbose level is set to 2"""
+    def refresh() -> None:
+        """Redraw the progress display, nothing is drawn if the output is not a terminal (CI, redirected output)"""
+        if RichConsole.live is not None and RichConsole.live.console.is_terminal:
+            RichConsole.live.refresh()
+
+    @staticmethod
+    def debug(msg: Union[str, Callable[[], str]]) -> None:
+        """Print a message if verbose level is set to 2, the message can be a callable to build it only if printed"""
         if RichConsole.verbose >= 2:
-            RichConsole.print(msg)
+            RichConsole.print(msg() if callable(msg) else msg)
 
     @staticmethod
     def info(msg: str) -> None:
@@ -95,8 +104,10 @@ class RichConsole:
     @staticmethod
     def one_shot_task(title: str) -> OneShotTaskContainer:
         """Create a one-shot task"""
-        return OneShotTaskContainer(task=RichConsole.progress_spinner.add_task(title, total=1, visible=True),
+        task = OneShotTaskContainer(task=RichConsole.progress_spinner.add_task(title, total=1, visible=True),
                                     progress=RichConsole.progress_spinner)
+        RichConsole.refresh()
+        return task
 
     @staticmethod
     def print(